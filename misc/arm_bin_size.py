@@ -5,8 +5,15 @@ import os
 import subprocess
 import argparse
 import re
+import mmap
+import json
+import hashlib
+from array import array
 from collections import defaultdict
-import math
+try:
+    from elftools.elf.elffile import ELFFile
+    from elftools.elf.constants import SH_FLAGS
+except ImportError: ELFFile = None  # Falls back to running SIZE_TOOL
 
 # --- Configuration ---
 TOOLCHAIN_PREFIX = "arm-none-eabi-"
@@ -16,17 +23,30 @@ DEFAULT_MEMORY_REGIONS = {
     "FLASH":      (0x08001100, 61184),
 }
 SIZE_TOOL = f"{TOOLCHAIN_PREFIX}size"
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "arm_bin_size")
 # --- End Configuration ---
 
+_BYTE_UNITS = (1024, 1024**2, 1024**3)
+_CACHE_VERSION = 1  # Bump whenever the linker memory parser, parse_linker_size or the patterns below change
+# Non-alloc section types that BFD (and thus 'size -A') does not report; everything else, including .comment/.debug_*, is listed
+_SIZE_SKIPPED_TYPES = {'SHT_NULL', 'SHT_SYMTAB', 'SHT_STRTAB', 'SHT_REL', 'SHT_RELA'}
+
+# Linker script patterns (bytes mode, compiled once)
+_C_COMMENT = re.compile(rb'/\*.*?\*/', re.DOTALL)
+_CPP_COMMENT = re.compile(rb'//.*?$', re.MULTILINE)
+_MEMORY_BLOCK = re.compile(rb'MEMORY\s*\{([^}]+)\}', re.IGNORECASE | re.DOTALL)
+_REGION_RE = re.compile(rb"^\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*\([^)]*\)\s*:\s*ORIGIN\s*=\s*([^,]+?)\s*,\s*LENGTH\s*=\s*([^,\s;}]+)", re.IGNORECASE | re.MULTILINE)
+_ALIAS_RE = re.compile(rb"^\s*REGION_ALIAS\s*\(\s*\"?([a-zA-Z_][a-zA-Z0-9_]*)\"?\s*,\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*\)", re.IGNORECASE | re.MULTILINE)
+
 def format_bytes(size_bytes):
     """Formats bytes into KB, MB, GB"""
     if size_bytes < 0: return f"({abs(size_bytes)} B)"
     if size_bytes == 0: return "0 B"
-    power = math.floor(math.log(max(1, size_bytes), 1024))
+    power = 0 if size_bytes < 1024 else (size_bytes.bit_length() - 1) // 10
     if power == 0: return f"{size_bytes} B"
-    elif power == 1: return f"{size_bytes / 1024:.2f} KB"
-    elif power == 2: return f"{size_bytes / (1024**2):.2f} MB"
-    else: return f"{size_bytes / (1024**3):.2f} GB"
+    elif power == 1: return f"{size_bytes / _BYTE_UNITS[0]:.2f} KB"
+    elif power == 2: return f"{size_bytes / _BYTE_UNITS[1]:.2f} MB"
+    else: return f"{size_bytes / _BYTE_UNITS[2]:.2f} GB"
 
 def parse_linker_size(size_str):
     """Parses linker script size strings like '20K', '0x1000', '64K - 4K'."""
@@ -52,44 +72,76 @@ def parse_linker_size(size_str):
     except ValueError: raise ValueError(f"Invalid size value format: {size_str}")
 
 def parse_linker_memory_file(filepath):
-    """Parses a linker memory definition file to extract MEMORY regions and aliases."""
+    """Returns the MEMORY regions of a linker file, reusing a cached parse while its mtime and size are unchanged."""
     print(f"Parsing linker memory file: {filepath}")
+    try: st = os.stat(filepath)
+    except FileNotFoundError: print(f"Error: Linker memory file not found: {filepath}", file=sys.stderr); return None
+    except OSError as e: print(f"Error parsing linker memory file {filepath}: {e}", file=sys.stderr); return None
+    return _cached_linker_memory_file(filepath, st.st_mtime_ns, st.st_size)
+
+def _cached_linker_memory_file(filepath, mtime_ns, size):
+    """Loads parsed regions from CACHE_DIR keyed by (path, _CACHE_VERSION, mtime, size), parsing and storing them on a miss.
+
+    The cache is JSON holding the regions and the region/alias/warning report, which is replayed on a hit.
+    """
+    key = hashlib.sha1(os.path.abspath(filepath).encode('utf-8')).hexdigest()
+    cache_file = os.path.join(CACHE_DIR, f"{key}-v{_CACHE_VERSION}-{mtime_ns}-{size}.json")
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as f: cached = json.load(f)
+        regions = {str(name): (int(origin), int(length)) for name, (origin, length) in cached['regions'].items()}
+        report = [(bool(err), str(text)) for err, text in cached['report']]
+    except Exception: regions = None
+    if regions:
+        for err, text in report: print(text, file=sys.stderr if err else sys.stdout)
+        return regions
+    report = []
+    def emit(text, err=False): report.append((err, text)); print(text, file=sys.stderr if err else sys.stdout)
+    regions = _parse_linker_memory_file(filepath, emit)
+    if regions:
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            for stale in os.listdir(CACHE_DIR):
+                if stale.startswith(f"{key}-") and not stale.endswith('.tmp'): os.remove(os.path.join(CACHE_DIR, stale))
+            tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f: json.dump({'regions': {name: list(r) for name, r in regions.items()}, 'report': report}, f)
+            os.replace(tmp_file, cache_file)
+        except OSError as e: print(f"Warning: Could not write linker memory cache {cache_file}: {e}", file=sys.stderr)
+    return regions
+
+def _parse_linker_memory_file(filepath, emit):
+    """Parses a linker memory definition file to extract MEMORY regions and aliases, reporting progress via emit(text, err)."""
     regions = {}
     aliases_to_resolve = []
     try:
-        with open(filepath, 'r', encoding='utf-8') as f: content = f.read()
-        content = re.sub(r'/\*.*?\*/', '', content, flags=re.DOTALL)
-        content = re.sub(r'//.*?$', '', content, flags=re.MULTILINE)
-        memory_match = re.search(r'MEMORY\s*\{([^}]+)\}', content, re.IGNORECASE | re.DOTALL)
+        with open(filepath, 'rb') as f: content = _CPP_COMMENT.sub(b'', _C_COMMENT.sub(b'', f.read()))
+        memory_match = _MEMORY_BLOCK.search(content)
         if not memory_match:
-            print(f"Warning: Could not find MEMORY {{...}} block in {filepath}", file=sys.stderr); return None
+            emit(f"Warning: Could not find MEMORY {{...}} block in {filepath}", err=True); return None
         memory_block = memory_match.group(1)
-        region_regex = re.compile(r"^\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*\([^)]*\)\s*:\s*ORIGIN\s*=\s*([^,]+?)\s*,\s*LENGTH\s*=\s*([^,\s;}]+)", re.IGNORECASE | re.MULTILINE)
-        for match in region_regex.finditer(memory_block):
-            name, origin_str, length_str = match.groups(); name = name.upper()
+        for match in _REGION_RE.finditer(memory_block):
+            name, origin_str, length_str = (g.decode('utf-8') for g in match.groups()); name = name.upper()
             try:
                 origin = parse_linker_size(origin_str); length = parse_linker_size(length_str)
                 regions[name] = (origin, length)
-                print(f"  Found Region: {name:<12} ORIGIN=0x{origin:08x}, LENGTH={length} ({format_bytes(length)})")
-            except ValueError as e: print(f"  Warning: Skipping region '{name}'. Cannot parse values: {e}", file=sys.stderr)
-        alias_regex = re.compile(r"^\s*REGION_ALIAS\s*\(\s*\"?([a-zA-Z_][a-zA-Z0-9_]*)\"?\s*,\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*\)", re.IGNORECASE | re.MULTILINE)
-        for match in alias_regex.finditer(content):
-            alias_name, target_name = match.groups(); alias_name = alias_name.upper(); target_name = target_name.upper()
-            aliases_to_resolve.append((alias_name, target_name)); print(f"  Found Alias: {alias_name} -> {target_name}")
+                emit(f"  Found Region: {name:<12} ORIGIN=0x{origin:08x}, LENGTH={length} ({format_bytes(length)})")
+            except ValueError as e: emit(f"  Warning: Skipping region '{name}'. Cannot parse values: {e}", err=True)
+        for match in _ALIAS_RE.finditer(content):
+            alias_name, target_name = (g.decode('utf-8') for g in match.groups()); alias_name = alias_name.upper(); target_name = target_name.upper()
+            aliases_to_resolve.append((alias_name, target_name)); emit(f"  Found Alias: {alias_name} -> {target_name}")
         for alias_name, target_name in aliases_to_resolve:
             if target_name in regions:
-                if alias_name not in regions: regions[alias_name] = regions[target_name]; print(f"  Resolved Alias: {alias_name} using {target_name}'s definition")
-                else: print(f"  Warning: Alias '{alias_name}' already defined, ignoring alias to '{target_name}'.", file=sys.stderr)
-            else: print(f"  Warning: Cannot resolve alias '{alias_name}', target region '{target_name}' not found.", file=sys.stderr)
-        if not regions: print(f"Warning: No valid memory regions parsed from {filepath}", file=sys.stderr); return None
+                if alias_name not in regions: regions[alias_name] = regions[target_name]; emit(f"  Resolved Alias: {alias_name} using {target_name}'s definition")
+                else: emit(f"  Warning: Alias '{alias_name}' already defined, ignoring alias to '{target_name}'.", err=True)
+            else: emit(f"  Warning: Cannot resolve alias '{alias_name}', target region '{target_name}' not found.", err=True)
+        if not regions: emit(f"Warning: No valid memory regions parsed from {filepath}", err=True); return None
         return regions
-    except FileNotFoundError: print(f"Error: Linker memory file not found: {filepath}", file=sys.stderr); return None
-    except Exception as e: print(f"Error parsing linker memory file {filepath}: {e}", file=sys.stderr); return None
+    except FileNotFoundError: emit(f"Error: Linker memory file not found: {filepath}", err=True); return None
+    except Exception as e: emit(f"Error parsing linker memory file {filepath}: {e}", err=True); return None
 
 def parse_size_output(size_output_lines):
     """Parses the output of 'arm-none-eabi-size -Ax'."""
     if not size_output_lines: print("Error: No input received from size tool", file=sys.stderr); return None
-    sections = []; headers = []; total_val_hex = None; elf_basename = "unknown"
+    names = []; sizes = array('Q'); addrs = array('Q'); headers = []; total_val_hex = None; elf_basename = "unknown"
     try:
         first_line = size_output_lines[0].strip(); match = re.match(r'^(.*?)\s*:\s*$', first_line)
         if match: elf_basename = os.path.basename(match.group(1))
@@ -109,42 +161,67 @@ def parse_size_output(size_output_lines):
             parts = line.split(None, 2)
             if len(parts) == 3:
                 name, size_hex, addr_hex = parts
-                try: sections.append({'name': name, 'size': int(size_hex, 16), 'addr': int(addr_hex, 16)})
+                try: size = int(size_hex, 16); addr = int(addr_hex, 16)
                 except ValueError: print(f"Warning: Could not parse line values: {line}", file=sys.stderr)
+                else: names.append(name); sizes.append(size); addrs.append(addr)
             else:
-                 if len(line.split()) == 1 and line.startswith('.'): sections.append({'name': line, 'size': 0, 'addr': 0}); # print(f"Warning: Assuming size 0 / addr 0 for line: {line}", file=sys.stderr) # Less verbose
+                 if len(line.split()) == 1 and line.startswith('.'): names.append(line); sizes.append(0); addrs.append(0); # print(f"Warning: Assuming size 0 / addr 0 for line: {line}", file=sys.stderr) # Less verbose
                  else: print(f"Warning: Skipping malformed line: {line}", file=sys.stderr)
         total_size_dec = 0
         if total_val_hex:
             try: total_size_dec = int(total_val_hex, 16)
             except ValueError: print(f"Warning: Could not parse total size '{total_val_hex}'", file=sys.stderr); total_val_hex = None
-        return elf_basename, headers, sections, total_size_dec
+        return elf_basename, headers, (names, sizes, addrs), total_size_dec
     except Exception as e: print(f"Error parsing size output: {e}", file=sys.stderr); return None
 
+def read_elf_sections(elf_path):
+    """Reads section headers directly from the ELF, listing the same sections and Total as 'size -Ax'."""
+    names = []; sizes = array('Q'); addrs = array('Q'); total_size_dec = 0
+    try:
+        with open(elf_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for sec in ELFFile(mm).iter_sections():
+                if sec['sh_type'] in _SIZE_SKIPPED_TYPES and not (sec['sh_flags'] & SH_FLAGS.SHF_ALLOC): continue
+                names.append(sec.name); sizes.append(sec['sh_size']); addrs.append(sec['sh_addr']); total_size_dec += sec['sh_size']
+        return os.path.basename(elf_path), ["section", "size", "addr"], (names, sizes, addrs), total_size_dec
+    except Exception as e: print(f"Error reading ELF sections from {elf_path}: {e}", file=sys.stderr); return None
+
+def run_size_tool(elf_path):
+    """Runs 'arm-none-eabi-size -Ax' and parses its output (used when pyelftools is unavailable)."""
+    cmd = [SIZE_TOOL, "-Ax", elf_path]; print(f"\nRunning: {' '.join(cmd)}")
+    try: result = subprocess.run(cmd, capture_output=True, text=True, check=False, encoding='utf-8', errors='ignore')
+    except FileNotFoundError: print(f"\nError: Command not found: '{SIZE_TOOL}'. Is toolchain in PATH?", file=sys.stderr); sys.exit(1)
+    except Exception as e: print(f"\nError running {SIZE_TOOL}: {e}", file=sys.stderr); sys.exit(1)
+
+    if result.returncode != 0: print(f"\nError: {SIZE_TOOL} failed ({result.returncode})\n--- stderr ---\n{result.stderr}\n--------------", file=sys.stderr); sys.exit(1)
+    return parse_size_output(result.stdout.splitlines())
+
 def print_cargo_style(elf_basename, headers, sections, total_size_dec):
     """Prints the size info in a format similar to cargo size."""
-    print(f"{elf_basename}  :")
-    max_name_len = len(headers[0]) if headers else len("section"); max_size_len = len(headers[1]) if headers else len("size"); max_addr_len = len(headers[2]) if headers else len("addr")
-    for sec in sections:
-        max_name_len = max(max_name_len, len(sec['name'])); max_size_len = max(max_size_len, len(str(sec['size']))); max_addr_len = max(max_addr_len, len(f"0x{sec['addr']:x}"))
-    max_name_len = max(max_name_len, len("Total"))
-    if total_size_dec is not None: max_size_len = max(max_size_len, len(str(total_size_dec)))
+    names, sizes, addrs = sections
     header_names = headers if headers else ["section", "size", "addr"]
-    print(f"{header_names[0]:<{max_name_len}} {header_names[1]:>{max_size_len}} {header_names[2]:>{max_addr_len}}")
-    for sec in sections: addr_str = f"0x{sec['addr']:x}"; print(f"{sec['name']:<{max_name_len}} {sec['size']:>{max_size_len}} {addr_str:>{max_addr_len}}")
-    if total_size_dec is not None: addr_padding = ' ' * max_addr_len; print(f"{'Total':<{max_name_len}} {total_size_dec:>{max_size_len}} {addr_padding}")
+    # Digit count grows with the value, so only the largest size/addr needs formatting
+    max_name_len = max(len(header_names[0]), max(map(len, names), default=0), len("Total"))
+    max_size_len = max(len(header_names[1]), len(str(max(sizes, default=0))), len(str(total_size_dec or 0)))
+    max_addr_len = max(len(header_names[2]), len(f"0x{max(addrs, default=0):x}"))
+    # Build every row with one pre-sized format string and emit the table in a single write
+    row_fmt = f"{{:<{max_name_len}}} {{:>{max_size_len}}} {{:>{max_addr_len}}}"
+    out = [f"{elf_basename}  :", row_fmt.format(*header_names[:3])]
+    out.extend(row_fmt.format(name, size, f"0x{addr:x}") for name, size, addr in zip(names, sizes, addrs))
+    if total_size_dec is not None: out.append(row_fmt.format("Total", total_size_dec, ""))
+    sys.stdout.write("\n".join(out) + "\n")
 
 def print_specific_sum(sections):
     """Calculates and prints the sum of vector table, .text, and .rodata."""
     sum_sections = {'.vectors', '.vector_table', '.text', '.rodata'}
     total = 0
     found_sections = []
-    for sec in sections:
-        if sec['name'] in sum_sections:
-            display_name = '.vector_table' if sec['name'] in {'.vectors', '.vector_table'} else sec['name']
+    names, sizes, _ = sections
+    for i, name in enumerate(names):
+        if name in sum_sections:
+            display_name = '.vector_table' if name in {'.vectors', '.vector_table'} else name
             if display_name not in found_sections:
                  found_sections.append(display_name)
-            total += sec['size']
+            total += sizes[i]
     if found_sections:
         print(f"\nSum of {' + '.join(sorted(list(found_sections)))}: {total} bytes")
     else:
@@ -154,36 +231,28 @@ def print_memory_region_summary(sections, memory_regions):
     """Prints a filtered CMake-like memory region usage summary with sizes in bytes."""
     print("\nMemory Region Summary:")
     if not memory_regions: print("  No memory regions defined or parsed."); return
-    regions_to_display = ["FLASH", "RAM"]; display_data = {}
+    regions_to_display = ["FLASH", "RAM"]; display_data = {}; names, sizes, addrs = sections
 
     # --- Calculate FLASH Usage (Code + ROData + Initialized Data LMA + Vector Table) ---
     flash_region_name = "FLASH"
     if flash_region_name in memory_regions:
         flash_region_start, flash_region_size = memory_regions[flash_region_name]
         flash_sections = {'.vectors', '.vector_table', '.text', '.rodata', '.ARM.exidx', '.ARM.extab', '.init_array', '.fini_array', '.glue_7', '.glue_7t', '.startup', '.data'}
-        flash_used_size = sum(sec['size'] for sec in sections if sec['name'] in flash_sections)
+        flash_used_size = sum(size for name, size in zip(names, sizes) if name in flash_sections)
         display_data[flash_region_name] = {"used": flash_used_size, "total": flash_region_size}
 
     # --- Calculate RAM Usage (Span including gaps for .data, .bss, .heap, .stack, .uninit) ---
     ram_region_name = "RAM"
     if ram_region_name in memory_regions:
         ram_region_start, ram_region_size = memory_regions[ram_region_name]; ram_used_size = 0
-        ram_sections = []
-        for sec in sections:
-            sec_start = sec['addr']
-            if ram_region_start <= sec_start < (ram_region_start + ram_region_size):
-                 # Include sections typically residing in RAM (VMA in RAM)
-                 if sec['name'] in {'.data', '.bss', '.heap', '.stack_dummy', '.uninit'} or 'ram' in sec['name'].lower():
-                    ram_sections.append(sec)
+        ram_region_end = ram_region_start + ram_region_size
+        # Include sections typically residing in RAM (VMA in RAM); holds indices into the section arrays
+        ram_sections = [i for i, (name, addr) in enumerate(zip(names, addrs))
+                        if ram_region_start <= addr < ram_region_end and (name in {'.data', '.bss', '.heap', '.stack_dummy', '.uninit'} or 'ram' in name.lower())]
         if not ram_sections: ram_used_size = 0
         else:
-            ram_sections.sort(key=lambda s: s['addr']); sum_of_sizes = sum(s['size'] for s in ram_sections)
-            first_section_start = ram_sections[0]['addr']; gap_before_first = max(0, first_section_start - ram_region_start)
-            inter_section_gaps = 0
-            for i in range(len(ram_sections) - 1):
-                current_end = ram_sections[i]['addr'] + ram_sections[i]['size']; next_start = ram_sections[i+1]['addr']
-                gap = max(0, next_start - current_end); inter_section_gaps += gap
-            ram_used_size = sum_of_sizes + gap_before_first + inter_section_gaps
+            # Span from region start to the furthest section end (includes leading and inter-section gaps, safe for overlap/containment)
+            ram_used_size = max(addrs[i] + sizes[i] for i in ram_sections) - ram_region_start
             if ram_used_size > ram_region_size: print(f"  Warning: Calculated RAM usage ({ram_used_size}) exceeds region size ({ram_region_size}). ", file=sys.stderr)
         display_data[ram_region_name] = {"used": ram_used_size, "total": ram_region_size}
 
@@ -221,14 +290,8 @@ def main():
         else: print("Warning: Failed parse linker memory file. Falling back to defaults.", file=sys.stderr); active_memory_regions = DEFAULT_MEMORY_REGIONS
     else: print("Info: Using internal default memory regions."); active_memory_regions = DEFAULT_MEMORY_REGIONS
 
-    cmd = [SIZE_TOOL, "-Ax", args.elf_file]; print(f"\nRunning: {' '.join(cmd)}")
-    try: result = subprocess.run(cmd, capture_output=True, text=True, check=False, encoding='utf-8', errors='ignore')
-    except FileNotFoundError: print(f"\nError: Command not found: '{SIZE_TOOL}'. Is toolchain in PATH?", file=sys.stderr); sys.exit(1)
-    except Exception as e: print(f"\nError running {SIZE_TOOL}: {e}", file=sys.stderr); sys.exit(1)
-
-    if result.returncode != 0: print(f"\nError: {SIZE_TOOL} failed ({result.returncode})\n--- stderr ---\n{result.stderr}\n--------------", file=sys.stderr); sys.exit(1)
-
-    size_lines = result.stdout.splitlines(); parsed_data = parse_size_output(size_lines)
+    if ELFFile is not None: print(f"\nReading sections: {args.elf_file}"); parsed_data = read_elf_sections(args.elf_file)
+    else: parsed_data = run_size_tool(args.elf_file)
     if parsed_data:
         elf_basename, headers, sections, total_size_dec = parsed_data
         print("-" * 60); print_cargo_style(elf_basename, headers, sections, total_size_dec)
@@ -236,7 +299,7 @@ def main():
         print("-" * 60); print_memory_region_summary(sections, active_memory_regions)
         # REMOVED call to print_final_summary
         print("-" * 60) # Keep final separator for neatness
-    else: print("\nError: Failed to parse the output from the size tool.", file=sys.stderr); sys.exit(1)
+    else: print("\nError: Failed to read section sizes from the ELF file.", file=sys.stderr); sys.exit(1)
 
 if __name__ == "__main__":
     main()